@@ -0,0 +1,108 @@
+"""
+Persistent codec cache.
+
+Codec ids are keyed by path and invalidated when the file's size or
+modification time changes, so repeated scans skip parsing unchanged files.
+"""
+
+import atexit
+import os
+import pickle
+import threading
+from typing import Callable, Optional
+
+from .const import CACHE_DIR
+
+CODEC_CACHE_FILE = os.path.join(CACHE_DIR, "codecs.pkl")
+
+
+class _PickleStore:
+    """Pickled container, loaded on first use and saved at exit if changed."""
+
+    def __init__(self, path: str, factory: Callable):
+        self.path = path
+        self.factory = factory
+        self.dirty = False
+        self._data = None
+        self._lock = threading.Lock()
+        atexit.register(self.save)
+
+    @property
+    def data(self):
+        """Get the container, loading it from disk if needed.
+
+        Returns
+        -------
+        Any
+            container created by factory
+        """
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    try:
+                        with open(self.path, "rb") as cache_file:
+                            data = pickle.load(cache_file)
+                    except Exception:  # pylint: disable=broad-except
+                        # missing or corrupt cache, start over
+                        data = None
+
+                    empty = self.factory()
+                    self._data = data if isinstance(data, type(empty)) else empty
+
+        return self._data
+
+    def save(self):
+        """Write the container to disk if it changed."""
+        if not self.dirty or self._data is None:
+            return
+
+        tmp_file = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(tmp_file, "wb") as cache_file:
+                pickle.dump(self._data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, self.path)
+        except OSError:
+            # the cache is only an optimization
+            pass
+
+
+# path -> (size, mtime_ns, codec_id)
+_codecs = _PickleStore(CODEC_CACHE_FILE, dict)
+
+
+def get_codec(path: str, stat: os.stat_result) -> Optional[str]:
+    """Get the cached codec id of a file.
+
+    Parameters
+    ----------
+    path : str
+        absolute file path
+    stat : os.stat_result
+        current stat of the file
+
+    Returns
+    -------
+    Optional[str]
+        codec id, or None if not cached or the file changed
+    """
+    entry = _codecs.data.get(path)
+    if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+        return None
+    return entry[2]
+
+
+def set_codec(path: str, stat: os.stat_result, codec_id: str):
+    """Cache the codec id of a file.
+
+    Parameters
+    ----------
+    path : str
+        absolute file path
+    stat : os.stat_result
+        current stat of the file
+    codec_id : str
+        codec id
+    """
+    _codecs.data[path] = (stat.st_size, stat.st_mtime_ns, codec_id)
+    _codecs.dirty = True
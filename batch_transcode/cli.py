@@ -3,18 +3,32 @@ Batch Transcode CLI
 """
 
 import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import chain, islice
+from operator import itemgetter
 from pathlib import Path
+from typing import Generator, Iterable, Optional
 
 import typer
 
 from batch_transcode.transcode import (
+    get_hevc_encoder,
     get_non_hevc_videos,
     get_videos,
     make_contact_sheet,
+    transcode_and_vcs,
     transcode_vid,
 )
 
-from .models import TranscodeFiles, VideoFiles, HevcDiscriminantMethods
+from .const import BATCH_SORT_LIMIT, FIND_CHUNK_SIZE, HEVC_SW_ENCODER, HW_ENCODER_JOBS
+from .models import (
+    TranscodeFiles,
+    TranscodeOptions,
+    TranscodeResult,
+    VideoFiles,
+    HevcDiscriminantMethods,
+)
 
 app = typer.Typer(
     help="""A cli to transcode video files and make video contact sheets.
@@ -30,6 +44,18 @@ def transcode(
     delete_source: bool = typer.Option(
         False, "-d", "--delete-source", help="Delete source file after transcoding."
     ),
+    encoder: str = typer.Option(
+        None, "-e", "--encoder", help="HEVC encoder to use (default: auto-detect)."
+    ),
+    force: bool = typer.Option(
+        False, "-f", "--force", help="Transcode even if the video is already HEVC."
+    ),
+    remux: bool = typer.Option(
+        False,
+        "-r",
+        "--remux",
+        help="Copy the streams of HEVC videos instead of re-encoding.",
+    ),
 ):
     """Transcode video file.
 
@@ -39,8 +65,23 @@ def transcode(
         video file to transcode
     delete_source : bool, optional
         delete source file after transcoding, by default False
+    encoder : str, optional
+        HEVC encoder to use, by default None (auto-detect)
+    force : bool, optional
+        transcode even if the video is already HEVC, by default False
+    remux : bool, optional
+        copy the streams of HEVC videos instead of re-encoding, by default False
     """
-    result = transcode_vid(TranscodeFiles.new(video_path))
+    result = transcode_vid(
+        TranscodeFiles.new(video_path),
+        options=TranscodeOptions(
+            encoder=encoder, skip_if_hevc=not (force or remux), remux_only=remux
+        ),
+    )
+
+    if result.skipped:
+        typer.echo(f"{video_path} is already HEVC, skipping. Use --remux or --force.")
+        return
 
     if delete_source:
         typer.echo(f"Removing {result.files.input}...")
@@ -88,10 +129,158 @@ def vcs(
         raise FileNotFoundError("Path or file doesn't exist: {video_path}")
 
 
+def _process_one(
+    transcode_files: TranscodeFiles, options: TranscodeOptions
+) -> TranscodeResult:
+    """Transcode a video and make the contact sheet of the output.
+
+    A partial output video is removed on failure, unless it existed before
+    the run. The contact sheet is only written once the transcode succeeds.
+
+    Parameters
+    ----------
+    transcode_files : TranscodeFiles
+        files to transcode
+    options : TranscodeOptions
+        transcoding options
+
+    Returns
+    -------
+    TranscodeResult
+        transcode result
+    """
+    output = transcode_files.output.video
+    existed = output.exists()
+
+    result = transcode_and_vcs(transcode_files, run_check=False, options=options)
+
+    if not result.ok() and not existed and output.is_file():
+        os.remove(output)
+
+    return result
+
+
+def _pending_transcodes(directory: Path) -> Generator:
+    """Generate files for the videos in a directory that still need transcoding.
+
+    Parameters
+    ----------
+    directory : Path
+        directory containing videos to transcode
+
+    Yields
+    ------
+    Generator
+        (transcode files, input size in bytes) tuples, with at most one per
+        output
+    """
+    outputs = set()
+
+    for vid_path in get_non_hevc_videos(directory):
+        transcode_files = TranscodeFiles.new(vid_path)
+        output = os.path.abspath(transcode_files.output.video)
+
+        if output in outputs:
+            # another video (e.g. foo.avi and foo.mkv) has the same output
+            continue
+        outputs.add(output)
+
+        if transcode_files.output.video.is_file():
+            # output file exists, so we skip
+            continue
+
+        try:
+            size = os.stat(transcode_files.input.video).st_size
+        except OSError:
+            # source disappeared since it was found
+            continue
+
+        yield transcode_files, size
+
+
+def _transcode_all(
+    queue: Iterable, options: TranscodeOptions, workers: int
+) -> Generator:
+    """Transcode videos on a pool of workers.
+
+    At most ``workers`` videos are submitted at a time, so nothing is left
+    queued when interrupted. Pending work is cancelled if the caller stops
+    iterating or an exception is raised.
+
+    Parameters
+    ----------
+    queue : Iterable
+        transcode files to process, in order
+    options : TranscodeOptions
+        transcoding options
+    workers : int
+        number of videos to transcode concurrently
+
+    Yields
+    ------
+    Generator
+        transcode results, as they complete
+    """
+    queue = iter(queue)
+    running = set()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                for transcode_files in islice(queue, workers - len(running)):
+                    running.add(executor.submit(_process_one, transcode_files, options))
+
+                if not running:
+                    return
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+
+def _finish_one(
+    transcode_result: TranscodeResult, move_source: Optional[Path], delete_source: bool
+):
+    """Report a successful transcode and move or delete its source files.
+
+    Parameters
+    ----------
+    transcode_result : TranscodeResult
+        successful transcode result
+    move_source : Path, optional
+        directory to move the source files to
+    delete_source : bool
+        delete the source files
+    """
+    typer.echo(f"Transcoded {transcode_result.files.input.video}")
+
+    if move_source is not None:
+        typer.echo(f"Moving {transcode_result.files.input} to {move_source}...")
+        # raise NotImplementedError
+        moved_video = VideoFiles.new(
+            move_source.joinpath(transcode_result.files.input.video.name)
+        )
+        os.rename(transcode_result.files.input.video, moved_video.video)
+        if transcode_result.files.input.vcs.is_file():
+            os.rename(transcode_result.files.input.vcs, moved_video.vcs)
+
+    if delete_source:
+        typer.echo(f"Removing {transcode_result.files}...")
+        os.remove(transcode_result.files.input.video)
+        if transcode_result.files.input.vcs.is_file():
+            os.remove(transcode_result.files.input.vcs)
+
+
 @app.command(help="Batch transcoding.")
 def batch(
     directory: Path = typer.Argument(
-        ..., help="Directory containing videos to transcode."
+        ...,
+        exists=True,
+        file_okay=False,
+        help="Directory containing videos to transcode.",
     ),
     move_source: Path = typer.Option(
         None, "-m", "--move-source", help="Move source files after transcoding."
@@ -99,6 +288,18 @@ def batch(
     delete_source: bool = typer.Option(
         False, "-d", "--delete-source", help="Delete source files after transcoding."
     ),
+    encoder: str = typer.Option(
+        None, "-e", "--encoder", help="HEVC encoder to use (default: auto-detect)."
+    ),
+    jobs: int = typer.Option(
+        None,
+        "-j",
+        "--jobs",
+        min=1,
+        help="Number of videos to transcode concurrently "
+        "(default: a quarter of the CPUs with libx265, "
+        f"{HW_ENCODER_JOBS} with a hardware encoder).",
+    ),
 ):
     """Batch Transcoding.
 
@@ -110,6 +311,11 @@ def batch(
         Move source files after transcoding, by default None
     delete_source : bool, optional
         Delete source files after transcoding, by default False
+    encoder : str, optional
+        HEVC encoder to use, by default None (auto-detect)
+    jobs : int, optional
+        Number of videos to transcode concurrently, by default a quarter of the
+        CPUs with libx265, or HW_ENCODER_JOBS with a hardware encoder
 
     Raises
     ------
@@ -129,45 +335,33 @@ def batch(
     if move_source is not None and not move_source.is_dir():
         raise FileNotFoundError(f"{move_source} is not an existing directory!")
 
-    errs = []
+    encoder = encoder or get_hevc_encoder()
+    software = encoder == HEVC_SW_ENCODER
+    cpus = os.cpu_count() or 1
 
-    for vid_path in get_non_hevc_videos(directory):
-        transcode_files = TranscodeFiles.new(vid_path)
+    if jobs is None:
+        jobs = max(1, cpus // 4) if software else HW_ENCODER_JOBS
 
-        if transcode_files.output.video.is_file():
-            # output file exists, so we skip
-            continue
+    # split the CPUs between libx265 jobs; hardware encoders don't use them
+    options = TranscodeOptions(
+        encoder=encoder,
+        threads=max(1, cpus // jobs) if software and jobs > 1 else None,
+    )
+    errs = []
 
-        transcode_result = transcode_vid(transcode_files, run_check=False)
+    pending = _pending_transcodes(directory)
+    # longest (largest) first, so big files don't hold up the pool at the end
+    largest_first = sorted(
+        islice(pending, BATCH_SORT_LIMIT), key=itemgetter(1), reverse=True
+    )
+    queue = (files for files, _ in chain(largest_first, pending))
 
+    for transcode_result in _transcode_all(queue, options, jobs):
         if not transcode_result.ok():
             errs.append(transcode_result)
-            if transcode_result.files.output.video.is_file():
-                os.remove(transcode_result.files.output.video)
             continue
 
-        vcs_result = make_contact_sheet(transcode_result.files.output, run_check=False)
-
-        if not vcs_result.ok():
-            errs.append(vcs_result)
-            if vcs_result.video.vcs.is_file():
-                os.remove(vcs_result.video.vcs)
-            continue
-
-        if move_source is not None:
-            typer.echo(f"Moving {transcode_result.files.input} to {move_source}...")
-            # raise NotImplementedError
-            moved_video = VideoFiles.new(
-                move_source.joinpath(transcode_result.files.input.video.name)
-            )
-            os.rename(transcode_result.files.input.video, moved_video.video)
-            if transcode_result.files.input.vcs.is_file():
-                os.rename(transcode_result.files.input.vcs, moved_video.vcs)
-
-        if delete_source:
-            typer.echo(f"Removing {transcode_files}...")
-            os.remove(transcode_result.files.input.video)
-            os.remove(transcode_result.files.input.vcs)
+        _finish_one(transcode_result, move_source, delete_source)
 
     if errs:
         typer.echo("Errors happened", err=True)
@@ -175,14 +369,29 @@ def batch(
         raise typer.Exit(1)
 
 
+def _write_all(fd: int, data: bytes):
+    """Write all data to a file descriptor, retrying partial writes.
+
+    Parameters
+    ----------
+    fd : int
+        file descriptor
+    data : bytes
+        data to write
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
 @app.command(help="Find non-HEVC video files.")
 def find(
-    directory: Path = typer.Argument(...),
+    directory: Path = typer.Argument(..., exists=True, file_okay=False),
     method: HevcDiscriminantMethods = typer.Option(
         HevcDiscriminantMethods.FAST.value,
         help="Method for determining if the file is HEVC encoded.",
     ),
-    limit: int = typer.Option(None, help="Limit the number of files to print."),
+    limit: int = typer.Option(None, min=0, help="Limit the number of files to print."),
 ):
     """Find non-HEVC video files.
 
@@ -195,13 +404,28 @@ def find(
     limit : int, optional
         Limit the number of files to print, by default None
     """
-    vids = get_non_hevc_videos(directory, method=method)
-    _iter = 1
-    for vid in vids:
-        if limit is not None and _iter > limit:
-            break
-        typer.echo(vid)
-        _iter += 1
+    vids = islice(get_non_hevc_videos(directory, method=method), limit)
+
+    if sys.stdout.isatty():
+        for vid in vids:
+            typer.echo(vid)
+        return
+
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, ValueError, OSError):
+        # stdout was replaced by something without a file descriptor
+        fd = None
+
+    # not interactive, so write in chunks straight to the file descriptor
+    # rather than flushing every line
+    sys.stdout.flush()
+    while chunk := list(islice(vids, FIND_CHUNK_SIZE)):
+        if fd is None:
+            sys.stdout.write("".join(f"{vid}\n" for vid in chunk))
+        else:
+            _write_all(fd, b"".join(os.fsencode(vid) + b"\n" for vid in chunk))
+    sys.stdout.flush()
 
 
 if __name__ == "__main__":
@@ -9,6 +9,64 @@ import os
 
 NICE_BIN = "/usr/bin/nice"
 FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "/usr/bin/ffmpeg")
+VCSI_BIN = os.environ.get("VCSI_BIN", "vcsi")
+
+# Number of videos batch sorts by size before transcoding; the rest are
+# transcoded in the order they are found.
+BATCH_SORT_LIMIT = 10000
+
+# Number of paths written at once by find when stdout isn't a terminal.
+FIND_CHUNK_SIZE = 1024
+
+# Contact sheet width in pixels and (columns, rows) of screenshots.
+VCS_WIDTH = 850
+VCS_GRID = (3, 5)
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "batch_transcode",
+)
+
+# Suffix replacing the extension of transcoded videos.
+TRANSCODED_SUFFIX = ".x265.mp4"
+
+# Files ending with this are assumed to be HEVC by the fast scan, e.g. also
+# "b-x265.mp4".
+HEVC_NAME_SUFFIX = "x265.mp4"
+
+# Force a specific HEVC encoder instead of auto-detecting one.
+HEVC_ENCODER = os.environ.get("HEVC_ENCODER")
+
+# Hardware HEVC encoders, in order of preference, with libx265 as the fallback.
+HEVC_HW_ENCODERS = ("hevc_nvenc", "hevc_amf", "hevc_qsv", "hevc_videotoolbox")
+HEVC_SW_ENCODER = "libx265"
+
+# Videos transcoded concurrently by default with a hardware encoder. The
+# encoder chip is the bottleneck, and consumer GPUs limit concurrent sessions.
+HW_ENCODER_JOBS = 2
+
+# Containers based on the ISO base media file format (MP4, QuickTime, ...).
+ISO_BMFF_EXTENSIONS = frozenset(
+    {
+        ".mp4",
+        ".m4v",
+        ".m4p",
+        ".mov",
+        ".qt",
+        ".3gp",
+        ".3g2",
+        ".f4v",
+        ".f4p",
+    }
+)
+
+# Bytes of the moov box to read when looking for the video sample entry.
+MP4_HEADER_BYTES = 65536
+
+# Number of threads checking codecs concurrently, and files per batch.
+DEFAULT_HEVC_WORKERS = 32
+HEVC_WORKERS = os.environ.get("BT_HEVC_WORKERS", str(DEFAULT_HEVC_WORKERS))
+HEVC_CHUNK_SIZE = 256
 
 VIDEO_FILE_EXTENSIONS = frozenset(
     {
@@ -61,3 +119,6 @@ VIDEO_FILE_EXTENSIONS = frozenset(
         ".movie",
     }
 )
+
+# Same as VIDEO_FILE_EXTENSIONS, for a single str.endswith call.
+VIDEO_FILE_EXTENSIONS_TUPLE = tuple(VIDEO_FILE_EXTENSIONS)
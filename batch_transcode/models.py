@@ -2,13 +2,17 @@
 Models
 """
 
+import os
 from pathlib import Path
 from dataclasses import dataclass
 from subprocess import CompletedProcess
 from enum import Enum
+from typing import Optional
 
+from .const import TRANSCODED_SUFFIX
 
-@dataclass
+
+@dataclass(slots=True)
 class VideoFiles:
     """Video Files"""
 
@@ -29,11 +33,12 @@ class VideoFiles:
         VideoFiles
             video files
         """
-        video = Path(video)
-        return VideoFiles(video=video, vcs=Path(f"{video}.jpg"))
+        if not isinstance(video, Path):
+            video = Path(video)
+        return VideoFiles(video=video, vcs=Path(os.fspath(video) + ".jpg"))
 
 
-@dataclass
+@dataclass(slots=True)
 class TranscodeFiles:
     """Transcoding Files"""
 
@@ -54,14 +59,26 @@ class TranscodeFiles:
         TranscodeFiles
             transcode files
         """
-        video_in = Path(video_in)
-        video_out = video_in.with_suffix(".x265.mp4")
+        if not isinstance(video_in, Path):
+            video_in = Path(video_in)
+        root, _ = os.path.splitext(os.fspath(video_in))
+        video_out = Path(root + TRANSCODED_SUFFIX)
         return TranscodeFiles(
             input=VideoFiles.new(video_in), output=VideoFiles.new(video_out)
         )
 
 
-@dataclass
+@dataclass(slots=True)
+class TranscodeOptions:
+    """Transcoding Options"""
+
+    encoder: Optional[str] = None
+    threads: Optional[int] = None
+    skip_if_hevc: bool = False
+    remux_only: bool = False
+
+
+@dataclass(slots=True)
 class AbstractResult:
     """Abstract Result"""
 
@@ -78,14 +95,15 @@ class AbstractResult:
         return self.result.returncode == 0
 
 
-@dataclass
+@dataclass(slots=True)
 class TranscodeResult(AbstractResult):
     """Transcoding process result"""
 
     files: TranscodeFiles
+    skipped: bool = False
 
 
-@dataclass
+@dataclass(slots=True)
 class VcsResult(AbstractResult):
     """Video contact sheet process result"""
 
@@ -2,22 +2,117 @@
 Transcoding.
 """
 
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from subprocess import run
-from typing import Generator
+from subprocess import DEVNULL, CompletedProcess, run
+from typing import Generator, Optional
 
 from pymediainfo import MediaInfo
 
-from .const import FFMPEG_BIN, NICE_BIN, VIDEO_FILE_EXTENSIONS
+from . import cache
+from .const import (
+    DEFAULT_HEVC_WORKERS,
+    FFMPEG_BIN,
+    HEVC_CHUNK_SIZE,
+    HEVC_ENCODER,
+    HEVC_HW_ENCODERS,
+    HEVC_NAME_SUFFIX,
+    HEVC_SW_ENCODER,
+    HEVC_WORKERS,
+    ISO_BMFF_EXTENSIONS,
+    MP4_HEADER_BYTES,
+    NICE_BIN,
+    VCS_GRID,
+    VCS_WIDTH,
+    VCSI_BIN,
+    VIDEO_FILE_EXTENSIONS_TUPLE,
+)
 from .models import (
     VcsResult,
     VideoFiles,
     TranscodeFiles,
+    TranscodeOptions,
     TranscodeResult,
     HevcDiscriminantMethods,
     HevcDiscriminantMethodException,
 )
 
+# Hardware decoder used with each encoder.
+ENCODER_HWACCEL = {
+    "hevc_nvenc": "cuda",
+}
+
+# ffmpeg arguments placed after the encoder selection, per encoder. Every
+# encoder gets a constant quality mode roughly comparable to libx265's default
+# CRF 28; otherwise the hardware encoders fall back to ffmpeg's generic
+# default bitrate of 200 kb/s (2 Mb/s cap for nvenc).
+ENCODER_OUTPUT_ARGS = {
+    "hevc_nvenc": ["-preset", "p4", "-rc", "vbr", "-cq", "24", "-b:v", "0"],
+    "hevc_amf": [
+        "-usage",
+        "transcoding",
+        "-quality",
+        "balanced",
+        "-rc",
+        "cqp",
+        "-qp_i",
+        "24",
+        "-qp_p",
+        "26",
+    ],
+    "hevc_qsv": ["-global_quality", "25"],
+    "hevc_videotoolbox": ["-q:v", "65"],
+}
+
+# timestamp in the corner of each contact sheet screenshot, like vcsi -t
+TIMESTAMP_FILTER = (
+    "drawtext=text='%{pts\\:hms}':x=w-tw-5:y=h-th-5"
+    ":fontsize=14:fontcolor=white:box=1:boxcolor=black@0.5:boxborderw=2"
+)
+
+
+def _walk(directory: str, exclude_suffix: Optional[str] = None) -> Generator:
+    """Recursively generate paths to video files using os.scandir.
+
+    Extensions are checked on the bare entry name, so no Path objects or
+    extra stat calls are made for non-video files. Like os.walk, directories
+    that can't be listed (missing, not a directory, no permission) are
+    skipped.
+
+    Parameters
+    ----------
+    directory : str
+        directory to search
+    exclude_suffix : str, optional
+        skip files whose name ends with this suffix, by default None
+
+    Yields
+    ------
+    Generator
+        generator of video file paths as strings
+    """
+    try:
+        entries = os.scandir(directory)
+    except OSError:
+        return
+
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path, exclude_suffix)
+                continue
+
+            name = entry.name
+            if exclude_suffix is not None and name.endswith(exclude_suffix):
+                continue
+
+            if name.lower().endswith(VIDEO_FILE_EXTENSIONS_TUPLE):
+                yield entry.path
+
 
 def get_videos(directory: Path) -> Generator:
     """Get all video files in a directory
@@ -33,11 +128,185 @@ def get_videos(directory: Path) -> Generator:
         generator of video files
     """
 
-    return (
-        f
-        for f in Path(directory).glob("**/*")
-        if f.suffix.lower() in VIDEO_FILE_EXTENSIONS
-    )
+    return map(Path, _walk(os.fspath(directory)))
+
+
+def _iter_boxes(buf: bytes, start: int, end: int) -> Generator:
+    """Generate the ISO-BMFF boxes found in a buffer.
+
+    Boxes cut off by the end of the buffer are truncated rather than dropped.
+
+    Parameters
+    ----------
+    buf : bytes
+        buffer
+    start : int
+        offset of the first box
+    end : int
+        offset after the last box
+
+    Yields
+    ------
+    Generator
+        (box type, payload start, payload end) tuples
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", buf, pos)
+        header_size = 8
+        if size == 1:
+            if pos + 16 > end:
+                return
+            (size,) = struct.unpack_from(">Q", buf, pos + 8)
+            header_size = 16
+        elif size == 0:
+            size = end - pos
+        if size < header_size:
+            return
+        yield box_type, pos + header_size, min(pos + size, end)
+        pos += size
+
+
+def _find_box(buf: bytes, start: int, end: int, path: tuple) -> Optional[tuple]:
+    """Find a nested box by following a path of box types.
+
+    Parameters
+    ----------
+    buf : bytes
+        buffer
+    start : int
+        offset of the first box
+    end : int
+        offset after the last box
+    path : tuple
+        box types to descend into, e.g. (b"minf", b"stbl", b"stsd")
+
+    Returns
+    -------
+    Optional[tuple]
+        (payload start, payload end) of the box, or None if not found
+    """
+    for box_type, box_start, box_end in _iter_boxes(buf, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return box_start, box_end
+            return _find_box(buf, box_start, box_end, path[1:])
+    return None
+
+
+def _codec_from_moov(moov: bytes) -> Optional[str]:
+    """Get the sample entry FourCC of the first video track in a moov payload.
+
+    Parameters
+    ----------
+    moov : bytes
+        (possibly truncated) payload of the moov box
+
+    Returns
+    -------
+    Optional[str]
+        codec id, or None if it isn't in the buffer
+    """
+    for box_type, start, end in _iter_boxes(moov, 0, len(moov)):
+        if box_type != b"trak":
+            continue
+
+        mdia = _find_box(moov, start, end, (b"mdia",))
+        if mdia is None:
+            return None
+
+        hdlr = _find_box(moov, *mdia, (b"hdlr",))
+        if hdlr is None:
+            return None
+        if moov[hdlr[0] + 8 : hdlr[0] + 12] != b"vide":
+            continue
+
+        stsd = _find_box(moov, *mdia, (b"minf", b"stbl", b"stsd"))
+        if stsd is None:
+            return None
+
+        # skip version, flags and entry count to the first sample entry
+        entry = stsd[0] + 8
+        if entry + 8 > stsd[1]:
+            return None
+        return moov[entry + 4 : entry + 8].decode("latin-1")
+
+    return None
+
+
+def _codec_from_mp4(media_file: str) -> Optional[str]:
+    """Get the codec id of an MP4 file by reading its box headers.
+
+    Only the top-level box headers and the start of the moov box are read;
+    other top-level boxes such as mdat are skipped over with seeks.
+
+    Parameters
+    ----------
+    media_file : str
+        MP4 file
+
+    Returns
+    -------
+    Optional[str]
+        codec id, or None if it couldn't be determined from the headers
+    """
+    with open(media_file, "rb") as mp4:
+        while True:
+            header = mp4.read(8)
+            if len(header) < 8:
+                return None
+
+            size, box_type = struct.unpack(">I4s", header)
+            header_size = 8
+            if size == 1:
+                large_size = mp4.read(8)
+                if len(large_size) < 8:
+                    return None
+                (size,) = struct.unpack(">Q", large_size)
+                header_size = 16
+
+            if box_type == b"moov":
+                if size == 0:
+                    return _codec_from_moov(mp4.read(MP4_HEADER_BYTES))
+                return _codec_from_moov(
+                    mp4.read(min(size - header_size, MP4_HEADER_BYTES))
+                )
+
+            if size < header_size:
+                # box extends to the end of the file, or is invalid
+                return None
+
+            mp4.seek(size - header_size, os.SEEK_CUR)
+
+
+def get_codec_id(media_file: Path) -> str:
+    """Get the codec id of the first video track of a media file.
+
+    MP4 headers are read directly, falling back to MediaInfo for other
+    containers. Results are cached on disk until the file changes.
+
+    Parameters
+    ----------
+    media_file : Path
+        media file to check
+
+    Returns
+    -------
+    str
+        codec id, e.g. "hvc1" or "avc1"
+    """
+    path = os.path.abspath(media_file)
+    stat = os.stat(path)
+
+    codec_id = cache.get_codec(path, stat)
+    if codec_id is None:
+        if os.path.splitext(path)[1].lower() in ISO_BMFF_EXTENSIONS:
+            codec_id = _codec_from_mp4(path)
+        if codec_id is None:
+            codec_id = MediaInfo.parse(path).video_tracks[0].codec_id or ""
+        cache.set_codec(path, stat, codec_id)
+
+    return codec_id
 
 
 def is_hevc(media_file: Path) -> bool:
@@ -53,7 +322,26 @@ def is_hevc(media_file: Path) -> bool:
     bool
         whether file is HEVC
     """
-    return MediaInfo.parse(media_file).video_tracks[0].codec_id in ["hev1", "hvc1"]
+    return get_codec_id(media_file) in ("hev1", "hvc1")
+
+
+@lru_cache(maxsize=None)
+def _hevc_executor() -> ThreadPoolExecutor:
+    """Get the thread pool checking codecs for the accurate scan.
+
+    Created on first use, so a bad BT_HEVC_WORKERS value can't break other
+    commands; it falls back to DEFAULT_HEVC_WORKERS.
+
+    Returns
+    -------
+    ThreadPoolExecutor
+        thread pool
+    """
+    try:
+        workers = int(HEVC_WORKERS)
+    except ValueError:
+        workers = DEFAULT_HEVC_WORKERS
+    return ThreadPoolExecutor(max_workers=max(1, workers))
 
 
 def get_non_hevc_videos(
@@ -75,56 +363,335 @@ def get_non_hevc_videos(
         generator of non-hevc files
     """
 
-    def fast(gen: Generator) -> Generator:
-        return (f for f in gen if not str(f).endswith("x265.mp4"))
-
     def accurate(gen: Generator) -> Generator:
-        return (f for f in gen if not is_hevc(f))
+        while chunk := list(islice(gen, HEVC_CHUNK_SIZE)):
+            for f, hevc in zip(chunk, _hevc_executor().map(is_hevc, chunk)):
+                if not hevc:
+                    yield f
 
-    all_vids = get_videos(directory)
+    directory = os.fspath(directory)
 
     if method == HevcDiscriminantMethods.FAST:
-        return fast(all_vids)
+        return map(Path, _walk(directory, exclude_suffix=HEVC_NAME_SUFFIX))
     if method == HevcDiscriminantMethods.ACCURATE:
-        return accurate(all_vids)
+        return map(Path, accurate(_walk(directory)))
     if method == HevcDiscriminantMethods.SEMI_ACCURATE:
-        return accurate(fast(all_vids))
+        return map(Path, accurate(_walk(directory, exclude_suffix=HEVC_NAME_SUFFIX)))
 
     raise HevcDiscriminantMethodException(f"Got a bad value for method: '{method}'")
 
 
-def transcode_vid(files: TranscodeFiles, run_check=True) -> TranscodeResult:
-    """Transcode video using FFMpeg
+def _encoder_works(encoder: str) -> bool:
+    """Whether FFMpeg can actually encode with the given encoder.
+
+    FFMpeg lists every encoder it was built with, even when the matching
+    hardware is missing, so encode a single blank frame to be sure, with
+    the same hardware decoder and output arguments as a real transcode.
+
+    Parameters
+    ----------
+    encoder : str
+        FFMpeg encoder name
+
+    Returns
+    -------
+    bool
+        whether the encoder works
+    """
+    hwaccel = ENCODER_HWACCEL.get(encoder)
+    cmd = [
+        FFMPEG_BIN,
+        "-hide_banner",
+        *(["-hwaccel", hwaccel] if hwaccel is not None else []),
+        "-f",
+        "lavfi",
+        "-i",
+        "color=size=256x256:duration=0.1",
+        "-frames:v",
+        "1",
+        "-c:v",
+        encoder,
+        *ENCODER_OUTPUT_ARGS.get(encoder, []),
+        "-f",
+        "null",
+        "-",
+    ]
+    return run(cmd, check=False, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
+
+
+@lru_cache(maxsize=None)
+def get_hevc_encoder() -> str:
+    """Get the best available HEVC encoder.
+
+    Hardware encoders are preferred over libx265. The result is cached, so
+    FFMpeg is only probed once per process.
+
+    Returns
+    -------
+    str
+        FFMpeg encoder name
+    """
+    if HEVC_ENCODER:
+        return HEVC_ENCODER
+
+    try:
+        result = run(
+            [FFMPEG_BIN, "-hide_banner", "-encoders"],
+            check=False,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return HEVC_SW_ENCODER
+
+    available = {
+        fields[1]
+        for fields in map(str.split, result.stdout.splitlines())
+        if len(fields) > 1
+    }
+
+    for encoder in HEVC_HW_ENCODERS:
+        if encoder in available and _encoder_works(encoder):
+            return encoder
+
+    return HEVC_SW_ENCODER
+
+
+def _skipped(files: TranscodeFiles) -> TranscodeResult:
+    """Result for a video that didn't need transcoding.
 
     Parameters
     ----------
     files : TranscodeFiles
-        file to transcode
+        files that were not transcoded
 
     Returns
     -------
     TranscodeResult
-        transcode results
+        successful, skipped transcode result
     """
+    return TranscodeResult(
+        files=files, result=CompletedProcess(args=[], returncode=0), skipped=True
+    )
 
-    cmd = [
+
+def _transcode_cmd(
+    files: TranscodeFiles, options: TranscodeOptions, gpu_frames: bool = True
+) -> list:
+    """Build the FFMpeg command transcoding the input to the output video.
+
+    Parameters
+    ----------
+    files : TranscodeFiles
+        file to transcode
+    options : TranscodeOptions
+        transcoding options
+    gpu_frames : bool, optional
+        keep hardware decoded frames in GPU memory, by default True. Disable
+        when other outputs need the frames for software filters.
+
+    Returns
+    -------
+    list
+        command arguments
+    """
+    if options.remux_only and is_hevc(files.input.video):
+        codec_args = ["-c:v", "copy", "-c:a", "copy", "-movflags", "+faststart"]
+        input_args = []
+    else:
+        encoder = options.encoder or get_hevc_encoder()
+        codec_args = [
+            "-c:v",
+            encoder,
+            *ENCODER_OUTPUT_ARGS.get(encoder, []),
+            *(["-threads", str(options.threads)] if options.threads else []),
+            "-c:a",
+            "aac",
+            "-strict",
+            "-2",
+        ]
+        input_args = []
+        hwaccel = ENCODER_HWACCEL.get(encoder)
+        if hwaccel is not None:
+            input_args = ["-hwaccel", hwaccel]
+            if gpu_frames:
+                input_args += ["-hwaccel_output_format", hwaccel]
+
+    return [
         NICE_BIN,
         "--adjustment=20",
         FFMPEG_BIN,
         "-hide_banner",
+        "-nostdin",
         "-n",
+        *input_args,
         "-i",
         str(files.input.video),
-        "-c:v",
-        "libx265",
-        "-c:a",
-        "aac",
-        "-strict",
-        "-2",
+        *codec_args,
         str(files.output.video),
     ]
 
-    result = run(cmd, check=run_check, capture_output=False)
+
+def transcode_vid(
+    files: TranscodeFiles,
+    run_check=True,
+    options: Optional[TranscodeOptions] = None,
+) -> TranscodeResult:
+    """Transcode video using FFMpeg
+
+    With ``options.skip_if_hevc``, HEVC inputs are not transcoded and a
+    skipped result is returned. With ``options.remux_only``, the streams of
+    HEVC inputs are copied into the output container instead of being
+    re-encoded; other inputs are still transcoded.
+
+    Parameters
+    ----------
+    files : TranscodeFiles
+        file to transcode
+    options : TranscodeOptions, optional
+        transcoding options, by default TranscodeOptions()
+
+    Returns
+    -------
+    TranscodeResult
+        transcode results
+    """
+    if options is None:
+        options = TranscodeOptions()
+
+    if options.skip_if_hevc and is_hevc(files.input.video):
+        return _skipped(files)
+
+    result = run(_transcode_cmd(files, options), check=run_check, capture_output=False)
+    return TranscodeResult(files=files, result=result)
+
+
+def _get_duration(media_file: Path) -> Optional[float]:
+    """Get the duration of a media file.
+
+    Parameters
+    ----------
+    media_file : Path
+        media file
+
+    Returns
+    -------
+    Optional[float]
+        duration in seconds, or None if unknown
+    """
+    general_tracks = MediaInfo.parse(media_file).general_tracks
+    try:
+        return float(general_tracks[0].duration) / 1000
+    except (IndexError, TypeError, ValueError):
+        return None
+
+
+@lru_cache(maxsize=None)
+def _drawtext_works() -> bool:
+    """Whether FFMpeg can draw the contact sheet timestamps.
+
+    The drawtext filter needs FFMpeg built with libfreetype and a font
+    found through fontconfig, so draw on a single blank frame to be sure.
+
+    Returns
+    -------
+    bool
+        whether the timestamp filter works
+    """
+    cmd = [
+        FFMPEG_BIN,
+        "-hide_banner",
+        "-f",
+        "lavfi",
+        "-i",
+        "color=size=256x256:duration=0.1",
+        "-frames:v",
+        "1",
+        "-vf",
+        TIMESTAMP_FILTER,
+        "-f",
+        "null",
+        "-",
+    ]
+    return run(cmd, check=False, stdout=DEVNULL, stderr=DEVNULL).returncode == 0
+
+
+def transcode_and_vcs(
+    files: TranscodeFiles,
+    run_check=True,
+    options: Optional[TranscodeOptions] = None,
+) -> TranscodeResult:
+    """Transcode video and make the contact sheet of the output in one FFMpeg run.
+
+    The input is demuxed and decoded once: the decoded frames feed both the
+    encoder and a select/scale/drawtext/tile filter producing the contact
+    sheet. Unlike vcsi, the contact sheet has no header, and the timestamps
+    are left out when FFMpeg can't draw text.
+
+    Parameters
+    ----------
+    files : TranscodeFiles
+        file to transcode
+    options : TranscodeOptions, optional
+        transcoding options, by default TranscodeOptions()
+
+    Returns
+    -------
+    TranscodeResult
+        transcode results
+    """
+    if options is None:
+        options = TranscodeOptions()
+
+    if options.skip_if_hevc and is_hevc(files.input.video):
+        return _skipped(files)
+
+    columns, rows = VCS_GRID
+    duration = _get_duration(files.input.video)
+    if duration:
+        # evenly spaced frames, like vcsi
+        step = duration / (columns * rows)
+        select = (
+            f"select='gte(t,{step / 2:.3f})"
+            f"*(isnan(prev_selected_t)+gte(t-prev_selected_t,{step:.3f}))'"
+        )
+    else:
+        select = "select='eq(pict_type,I)'"
+
+    filters = [select, f"scale={VCS_WIDTH // columns}:-1"]
+    if _drawtext_works():
+        filters.append(TIMESTAMP_FILTER)
+    filters.append(f"tile={columns}x{rows}")
+
+    # write the sheet next to its final name and only rename it once the
+    # transcode succeeds, so a failed run never leaves a partial sheet behind
+    vcs = files.output.vcs
+    tmp_vcs = vcs.with_name(f".{vcs.name}.tmp.jpg")
+    if tmp_vcs.is_file():
+        os.remove(tmp_vcs)
+
+    cmd = [
+        *_transcode_cmd(files, options, gpu_frames=False),
+        "-map",
+        "0:v:0",
+        "-an",
+        "-vf",
+        ",".join(filters),
+        "-frames:v",
+        "1",
+        "-q:v",
+        "3",
+        str(tmp_vcs),
+    ]
+
+    try:
+        result = run(cmd, check=run_check, capture_output=False)
+        if result.returncode == 0:
+            os.replace(tmp_vcs, vcs)
+    finally:
+        if tmp_vcs.is_file():
+            os.remove(tmp_vcs)
+
     return TranscodeResult(files=files, result=result)
 
 
@@ -141,6 +708,18 @@ def make_contact_sheet(video: VideoFiles, run_check: bool = True) -> VcsResult:
     VcsResult
         vcs result
     """
-    cmd = f'nice --adjustment=20 vcsi "{video.video}" -t -w 850 -g 3x5 -o "{video.vcs}"'
-    result = run(cmd, shell=True, check=run_check)
+    cmd = [
+        NICE_BIN,
+        "--adjustment=20",
+        VCSI_BIN,
+        str(video.video),
+        "-t",
+        "-w",
+        str(VCS_WIDTH),
+        "-g",
+        "x".join(map(str, VCS_GRID)),
+        "-o",
+        str(video.vcs),
+    ]
+    result = run(cmd, check=run_check)
     return VcsResult(video=video, result=result)
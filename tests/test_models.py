@@ -0,0 +1,46 @@
+"""
+Tests for the file path models.
+"""
+
+# pylint: disable=missing-function-docstring
+
+import unittest
+from pathlib import Path
+
+from batch_transcode.models import TranscodeFiles, VideoFiles
+
+
+class TestVideoFiles(unittest.TestCase):
+    """VideoFiles.new"""
+
+    def test_contact_sheet_path(self):
+        files = VideoFiles.new(Path("/videos/a.b.mkv"))
+        self.assertEqual(files.video, Path("/videos/a.b.mkv"))
+        self.assertEqual(files.vcs, Path("/videos/a.b.mkv.jpg"))
+
+    def test_str_path(self):
+        files = VideoFiles.new("videos/a.mkv")
+        self.assertEqual(files.video, Path("videos/a.mkv"))
+        self.assertEqual(files.vcs, Path("videos/a.mkv.jpg"))
+
+
+class TestTranscodeFiles(unittest.TestCase):
+    """TranscodeFiles.new"""
+
+    def test_paths(self):
+        files = TranscodeFiles.new(Path("/videos/a.b.mkv"))
+        self.assertEqual(files.input, VideoFiles.new(Path("/videos/a.b.mkv")))
+        self.assertEqual(files.output.video, Path("/videos/a.b.x265.mp4"))
+        self.assertEqual(files.output.vcs, Path("/videos/a.b.x265.mp4.jpg"))
+
+    def test_same_as_with_suffix(self):
+        for name in ("a.avi", "a.b.MP4", ".hidden.mkv", "dir.d/a.mts", "noext"):
+            with self.subTest(name=name):
+                video = Path("/videos", name)
+                files = TranscodeFiles.new(str(video))
+                self.assertEqual(files.output.video, video.with_suffix(".x265.mp4"))
+                self.assertEqual(files.output.vcs, video.with_suffix(".x265.mp4.jpg"))
+
+
+if __name__ == "__main__":
+    unittest.main()
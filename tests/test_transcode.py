@@ -0,0 +1,351 @@
+"""
+Tests for finding videos, reading codec ids from MP4 box headers and building
+FFMpeg commands.
+"""
+
+# the box parser is private, and test names describe each case
+# pylint: disable=protected-access,missing-function-docstring
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+from pathlib import Path
+from subprocess import CompletedProcess
+from types import SimpleNamespace
+from unittest import mock
+
+from batch_transcode import transcode
+from batch_transcode.const import MP4_HEADER_BYTES
+from batch_transcode.models import (
+    HevcDiscriminantMethods,
+    TranscodeFiles,
+    TranscodeOptions,
+)
+
+
+VIDEOS = ("a.mp4", "B.MKV", "sub/c.avi", "sub/deep/d.WebM")
+HEVC_NAMED_VIDEOS = ("e.x265.mp4", "sub/b-x265.mp4")
+OTHER_FILES = ("notes.txt", "a.mp4.jpg", "sub/.e.x265.mp4.jpg.tmp.jpg", "mp4")
+
+
+class TestFindVideos(unittest.TestCase):
+    """get_videos / get_non_hevc_videos"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        for name in VIDEOS + HEVC_NAMED_VIDEOS + OTHER_FILES:
+            path = Path(self.tmp_dir, name)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.touch()
+        Path(self.tmp_dir, "empty.mkv").mkdir()
+
+        # "c" stands in for an HEVC video without x265 in its name
+        patcher = mock.patch.object(
+            transcode, "is_hevc", side_effect=lambda path: path.endswith("c.avi")
+        )
+        self.is_hevc = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def paths(self, *names: str) -> list:
+        """Sorted paths of files in the temporary directory."""
+        return sorted(Path(self.tmp_dir, name) for name in names)
+
+    def test_get_videos(self):
+        self.assertEqual(
+            sorted(transcode.get_videos(Path(self.tmp_dir))),
+            self.paths(*VIDEOS, *HEVC_NAMED_VIDEOS),
+        )
+
+    def test_missing_directory(self):
+        self.assertEqual(list(transcode.get_videos(Path(self.tmp_dir, "nope"))), [])
+        self.assertEqual(list(transcode.get_videos(Path(self.tmp_dir, "a.mp4"))), [])
+
+    def test_fast(self):
+        videos = transcode.get_non_hevc_videos(
+            Path(self.tmp_dir), HevcDiscriminantMethods.FAST
+        )
+        self.assertEqual(sorted(videos), self.paths(*VIDEOS))
+        self.is_hevc.assert_not_called()
+
+    def test_semi_accurate(self):
+        videos = transcode.get_non_hevc_videos(
+            Path(self.tmp_dir), HevcDiscriminantMethods.SEMI_ACCURATE
+        )
+        self.assertEqual(
+            sorted(videos), self.paths("a.mp4", "B.MKV", "sub/deep/d.WebM")
+        )
+        checked = sorted(Path(call.args[0]) for call in self.is_hevc.call_args_list)
+        self.assertEqual(checked, self.paths(*VIDEOS))
+
+    def test_accurate(self):
+        videos = transcode.get_non_hevc_videos(
+            Path(self.tmp_dir), HevcDiscriminantMethods.ACCURATE
+        )
+        self.assertEqual(
+            sorted(videos),
+            self.paths("a.mp4", "B.MKV", "sub/deep/d.WebM", *HEVC_NAMED_VIDEOS),
+        )
+
+
+def box(box_type: bytes, payload: bytes = b"") -> bytes:
+    """Build a box with a 32-bit size."""
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def large_box(box_type: bytes, payload: bytes = b"") -> bytes:
+    """Build a box with size == 1 and a 64-bit largesize."""
+    return struct.pack(">I4sQ", 1, box_type, 16 + len(payload)) + payload
+
+
+def full_box(box_type: bytes, payload: bytes) -> bytes:
+    """Build a box with version and flags."""
+    return box(box_type, b"\0\0\0\0" + payload)
+
+
+def trak(handler: bytes, fourcc: bytes, padding: int = 0) -> bytes:
+    """Build a track with a handler and a single sample entry.
+
+    ``padding`` bytes of sample table follow the sample description, like
+    the stts/stsz/stco tables of a real track.
+    """
+    hdlr = full_box(b"hdlr", b"\0\0\0\0" + handler + b"\0" * 12)
+    stsd = full_box(b"stsd", struct.pack(">I", 1) + box(fourcc, b"\0" * 78))
+    stbl = box(b"stbl", stsd + box(b"stts", b"\0" * padding))
+    minf = box(b"minf", box(b"vmhd", b"\0" * 12) + stbl)
+    mdia = box(b"mdia", box(b"mdhd", b"\0" * 24) + hdlr + minf)
+    return box(b"trak", box(b"tkhd", b"\0" * 84) + mdia)
+
+
+def moov(*traks: bytes) -> bytes:
+    """Build a movie box."""
+    return box(b"moov", box(b"mvhd", b"\0" * 100) + b"".join(traks))
+
+
+FTYP = box(b"ftyp", b"isom\0\0\0\0isomiso2")
+MDAT = box(b"mdat", b"\1" * 100_000)
+VIDEO_MOOV = moov(trak(b"vide", b"hvc1"))
+
+
+class Mp4TestCase(unittest.TestCase):
+    """Test case writing MP4 files to a temporary directory"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write(self, data: bytes) -> str:
+        """Write an MP4 file and return its path."""
+        path = os.path.join(self.tmp_dir, "video.mp4")
+        with open(path, "wb") as mp4:
+            mp4.write(data)
+        return path
+
+
+class TestCodecFromMp4(Mp4TestCase):
+    """_codec_from_mp4 / _codec_from_moov"""
+
+    def test_moov_before_mdat(self):
+        self.assertEqual(
+            transcode._codec_from_mp4(self.write(FTYP + VIDEO_MOOV + MDAT)), "hvc1"
+        )
+
+    def test_moov_after_mdat(self):
+        self.assertEqual(
+            transcode._codec_from_mp4(self.write(FTYP + MDAT + VIDEO_MOOV)), "hvc1"
+        )
+
+    def test_audio_trak_first(self):
+        data = moov(trak(b"soun", b"mp4a"), trak(b"vide", b"avc1"))
+        self.assertEqual(transcode._codec_from_mp4(self.write(FTYP + data)), "avc1")
+
+    def test_large_size_boxes(self):
+        data = (
+            FTYP
+            + large_box(b"mdat", b"\1" * 1000)
+            + large_box(b"moov", box(b"mvhd", b"\0" * 100) + trak(b"vide", b"hev1"))
+        )
+        self.assertEqual(transcode._codec_from_mp4(self.write(data)), "hev1")
+
+    def test_moov_to_end_of_file(self):
+        zero_size_moov = struct.pack(">I", 0) + VIDEO_MOOV[4:]
+        self.assertEqual(
+            transcode._codec_from_mp4(self.write(FTYP + MDAT + zero_size_moov)),
+            "hvc1",
+        )
+
+    def test_mdat_to_end_of_file(self):
+        zero_size_mdat = struct.pack(">I", 0) + MDAT[4:]
+        self.assertEqual(
+            transcode._codec_from_mp4(self.write(FTYP + VIDEO_MOOV + zero_size_mdat)),
+            "hvc1",
+        )
+        # moov can't follow a box that extends to the end of the file
+        self.assertIsNone(
+            transcode._codec_from_mp4(self.write(FTYP + zero_size_mdat + VIDEO_MOOV))
+        )
+
+    def test_no_moov(self):
+        self.assertIsNone(transcode._codec_from_mp4(self.write(FTYP + MDAT)))
+        self.assertIsNone(transcode._codec_from_mp4(self.write(b"")))
+
+    def test_no_video_trak(self):
+        data = moov(trak(b"soun", b"mp4a"))
+        self.assertIsNone(transcode._codec_from_moov(data[8:]))
+
+    def test_truncated_moov(self):
+        # the audio sample tables push the video track past the bytes read
+        data = moov(
+            trak(b"soun", b"mp4a", padding=MP4_HEADER_BYTES), trak(b"vide", b"hvc1")
+        )
+        self.assertIsNone(transcode._codec_from_mp4(self.write(FTYP + data)))
+
+
+class TestGetCodecId(Mp4TestCase):
+    """get_codec_id"""
+
+    def setUp(self):
+        super().setUp()
+
+        # keep the persistent cache out of the way
+        for name in ("get_codec", "set_codec"):
+            patcher = mock.patch.object(
+                transcode.cache, name, return_value=None, autospec=True
+            )
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(transcode, "MediaInfo", autospec=True)
+        self.media_info = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.media_info.parse.return_value = SimpleNamespace(
+            video_tracks=[SimpleNamespace(codec_id="hev1")]
+        )
+
+    def test_reads_headers(self):
+        path = self.write(FTYP + MDAT + VIDEO_MOOV)
+        self.assertEqual(transcode.get_codec_id(path), "hvc1")
+        self.media_info.parse.assert_not_called()
+
+    def test_truncated_moov_falls_back_to_mediainfo(self):
+        data = moov(
+            trak(b"soun", b"mp4a", padding=MP4_HEADER_BYTES), trak(b"vide", b"hvc1")
+        )
+        path = self.write(FTYP + data)
+        self.assertEqual(transcode.get_codec_id(path), "hev1")
+        self.media_info.parse.assert_called_once_with(path)
+
+
+class TestTranscodeAndVcs(unittest.TestCase):
+    """transcode_and_vcs"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.files = TranscodeFiles.new(Path(self.tmp_dir, "video.avi"))
+        self.tmp_vcs = Path(self.tmp_dir, ".video.x265.mp4.jpg.tmp.jpg")
+
+        self.returncode = 0
+        self.patch("run", side_effect=self.fake_run)
+        self.patch("_get_duration", return_value=150.0)
+        self.drawtext_works = self.patch("_drawtext_works", return_value=True)
+
+    def patch(self, name: str, **kwargs) -> mock.MagicMock:
+        """Patch a name in the transcode module for the test."""
+        patcher = mock.patch.object(transcode, name, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def fake_run(self, cmd: list, **_) -> CompletedProcess:
+        """Write the contact sheet, like FFMpeg does."""
+        self.cmd = cmd  # pylint: disable=attribute-defined-outside-init
+        Path(cmd[-1]).write_bytes(b"jpg")
+        return CompletedProcess(cmd, self.returncode)
+
+    def transcode(self, encoder: str = "libx265"):
+        """Run transcode_and_vcs and return the video filter graph."""
+        result = transcode.transcode_and_vcs(
+            self.files, run_check=False, options=TranscodeOptions(encoder=encoder)
+        )
+        self.assertIs(result.files, self.files)
+        return self.cmd[self.cmd.index("-vf") + 1]
+
+    def test_command(self):
+        filters = self.transcode()
+        self.assertEqual(self.cmd[-1], str(self.tmp_vcs))
+        self.assertIn(str(self.files.output.video), self.cmd)
+        index = self.cmd.index("-map")
+        self.assertEqual(self.cmd[index : index + 3], ["-map", "0:v:0", "-an"])
+        self.assertTrue(filters.startswith("select='gte(t,5.000)*"))
+        self.assertTrue(
+            filters.endswith(f",scale=283:-1,{transcode.TIMESTAMP_FILTER},tile=3x5")
+        )
+
+    def test_renames_sheet(self):
+        self.transcode()
+        self.assertEqual(self.files.output.vcs.read_bytes(), b"jpg")
+        self.assertFalse(self.tmp_vcs.exists())
+
+    def test_failure_keeps_existing_sheet(self):
+        self.files.output.vcs.write_bytes(b"old")
+        self.returncode = 1
+        self.transcode()
+        self.assertEqual(self.files.output.vcs.read_bytes(), b"old")
+        self.assertFalse(self.tmp_vcs.exists())
+
+    def test_no_drawtext(self):
+        self.drawtext_works.return_value = False
+        filters = self.transcode()
+        self.assertNotIn("drawtext", filters)
+        self.assertTrue(filters.endswith(",scale=283:-1,tile=3x5"))
+
+    def test_hwaccel_frames_stay_in_memory(self):
+        self.transcode(encoder="hevc_nvenc")
+        index = self.cmd.index("-hwaccel")
+        self.assertEqual(self.cmd[index + 1], "cuda")
+        self.assertNotIn("-hwaccel_output_format", self.cmd)
+
+
+class TestGetHevcEncoder(unittest.TestCase):
+    """get_hevc_encoder"""
+
+    def setUp(self):
+        transcode.get_hevc_encoder.cache_clear()
+        self.addCleanup(transcode.get_hevc_encoder.cache_clear)
+
+        patcher = mock.patch.object(transcode, "HEVC_ENCODER", "")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(transcode, "run", side_effect=self.fake_run)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.probes = []
+
+    def fake_run(self, cmd: list, **_) -> CompletedProcess:
+        """List nvenc, and reject the probe unless it uses CUDA decoding."""
+        if "-encoders" in cmd:
+            return CompletedProcess(cmd, 0, stdout=" V....D hevc_nvenc  NVIDIA\n")
+        self.probes.append(cmd)
+        return CompletedProcess(cmd, 0 if "-hwaccel" in cmd else 1)
+
+    def test_probe_uses_transcode_arguments(self):
+        self.assertEqual(transcode.get_hevc_encoder(), "hevc_nvenc")
+        self.assertEqual(len(self.probes), 1)
+        probe = self.probes[0]
+        self.assertEqual(probe[probe.index("-hwaccel") + 1], "cuda")
+        index = probe.index("hevc_nvenc") + 1
+        output_args = transcode.ENCODER_OUTPUT_ARGS["hevc_nvenc"]
+        self.assertEqual(probe[index : index + len(output_args)], output_args)
+
+    def test_rejected_arguments_fall_back_to_libx265(self):
+        with mock.patch.dict(transcode.ENCODER_HWACCEL, clear=True):
+            self.assertEqual(transcode.get_hevc_encoder(), "libx265")
+        self.assertEqual(len(self.probes), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()